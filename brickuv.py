@@ -1,8 +1,10 @@
 import bpy
 import bmesh
-import math
 import random
-from mathutils import Vector, Matrix
+import numpy as np
+from collections import deque
+from itertools import chain
+from mathutils import Vector
 
 class Params:
 	def __init__(self, texture_size, cell_size, rotate, offset, double_halves, coplanar, random, subdiv):
@@ -17,174 +19,196 @@ class Params:
 
 		self.subdivs = cell_size if subdiv else Vector((1, 1))
 
-_islands = []
+_islands = None
+_grids = None # (key, grids) of the last run, reused while the selected faces are unchanged.
 _params = None
-
-def find_island(face):
-	for i in _islands:
-		if face in i.faces:
-			return i
-	return None
-
-def increment_loop(loop, count):
-	for i in range(count):
-		loop = loop.link_loop_next
-	return loop
+_rng = random.Random()
+
+# Per edge of a face (CCW from bottom): loop offset into the twin face, and grid step to it.
+_twin_adjust_loop = (2, 1, 0, 3)
+_twin_delta_x = (0, 1, 0, -1)
+_twin_delta_y = (-1, 0, 1, 0)
+
+def quad_loops(loops, first, rotate):
+	# A quad's loops in UV corner order, starting at the bottom loop loops[first].
+	step = -1 if rotate else 1
+	return tuple(loops[(first + i * step) % 4] for i in range(4))
+
+def bottom_loop(loops):
+	# Position of the loop with the lowest vertex, so islands get a consistent orientation.
+	cos = [l.vert.co for l in loops]
+	return min(range(4), key=lambda i: (cos[i].z, cos[i].y, cos[i].x))
+
+class Adjacency:
+	# Links between the selected quads, so flood fills walk integer tables rather than BMesh loops.
+	# Faces are identified by index; links by face index * 4 + loop position.
+	def __init__(self, bm, selected):
+		face_count = len(bm.faces)
+		self.loops = [None] * face_count # Loops of each selected quad.
+		self.neighbours = [-1] * (face_count * 4) # Selected face across each loop's edge, or -1.
+		self.entries = [0] * (face_count * 4) # Position of the neighbour's loop on the shared edge.
+
+		for face in selected:
+			loops = tuple(face.loops)
+			if len(loops) == 4:
+				self.loops[face.index] = loops
+
+		for face in selected:
+			f = face.index
+			if self.loops[f]:
+				for i, loop in enumerate(self.loops[f]):
+					twin = loop.link_loop_radial_next
+					g = twin.face.index
+					if g != f and self.loops[g]:
+						self.neighbours[f * 4 + i] = g
+						self.entries[f * 4 + i] = self.loops[g].index(twin)
 
 class FaceGrid:
-	class Item:
-		def __init__(self, loop, x, y):
-			self.loop = loop # Treat as bottom loop, y going upwards.
-			self.x = x
-			self.y = y
-
-	def __init__(self, loop):
-		self.faces = set()
-		self.items = []
-		self.min_x = self.min_y = self.max_x = self.max_y = 0
-
-		if not loop.face.select:
-			raise RuntimeError('FaceGrid: face not selected')
-
-		doing = [FaceGrid.Item(loop, 0, 0)]		
-		self.faces.add(loop.face)
-
-		while doing:
-			new_items = []
-			print('FaceGrid: doing %d items' % len(doing))
-			for item in doing:
-				self.min_x = min(self.min_x, item.x)
-				self.min_y = min(self.min_y, item.y)
-				self.max_x = max(self.max_x, item.x)
-				self.max_y = max(self.max_y, item.y)
-				neighbours = self.create_neighbour_items(item)
-				new_items.extend(neighbours)
-				self.faces.update([i.loop.face for i in neighbours])
-			self.items.extend(doing)
-			doing = new_items
-
-		print('FaceGrid: width = %d, height = %d, faces = %d' % (1 + self.max_x - self.min_x, 1 + self.max_y - self.min_y, len(self.items)))
-
-	def create_neighbour_items(self, item):
-		twin_adjust_loop = [2, 1, 0, 3]
-		twin_delta_x = [0, 1, 0, -1]
-		twin_delta_y = [-1, 0, 1, 0]
-		
-		items = []
-		loop = item.loop
-		for i in range(4):
-			twin = loop.link_loop_radial_next
-			if twin and twin.face.select:
-				if not twin.face in self.faces:
-					items.append(FaceGrid.Item(increment_loop(twin, twin_adjust_loop[i]), item.x + twin_delta_x[i], item.y + twin_delta_y[i]))
-			loop = loop.link_loop_next
-		return items
-
-class Cell:
-	class Face:
-		def __init__(self, loop, x, y):
-			self.loop, self.x, self.y = loop, x, y
-
-	def __init__(self):
+	# Holds face indices and loop positions only, so it outlives the BMesh it was built from.
+	__slots__ = ('faces', 'firsts', 'xs', 'ys', 'width', 'height')
+
+	def __init__(self, adjacency, face, visited):
 		self.faces = []
-		self.is_end = [False] * 4 # CCW from bottom.
-
-class Island:
-	def __init__(self, face):
-		# Try to use loop with consistent orientation.
-		best = face.loops[0]
-		for i in range(1, 4):
-			v = face.loops[i].vert.co
-			b = best.vert.co
-			if (v.z < b.z) or (v.z == b.z and v.y < b.y) or (v.z == b.z and v.y == b.y and v.x < b.x):
-				best = face.loops[i]
-	
-		# Find contiguous faces and assign them to cells.
-		grid = FaceGrid(best)
-		self.faces = grid.faces
-		self.width = 1 + grid.max_x - grid.min_x
-		self.height = 1 + grid.max_y - grid.min_y
-		self.rows = [[None] * self.width for i in range(self.height)]
-		for item in grid.items:
-			face_x = item.x - grid.min_x
-			face_y = item.y - grid.min_y
-			cell_x = face_x // int(_params.subdivs.x)
-			cell_y = face_y // int(_params.subdivs.y)
-
-			cell = self.rows[cell_y][cell_x]
-			if not cell:
-				cell = self.rows[cell_y][cell_x] = Cell()
-
-			cell.faces.append(Cell.Face(item.loop, face_x % _params.subdivs.x, face_y % _params.subdivs.y))
-			
-		# Set cells border states.
-		for y in range(self.height):
-			for x in range(self.width):
-				cell = self.rows[y][x]
-				if cell:
-					cell.is_end[0] = y == 0 or not self.rows[y - 1][x]
-					cell.is_end[1] = x == self.width - 1 or not self.rows[y][x + 1]
-					cell.is_end[2] = y == self.height - 1 or not self.rows[y + 1][x]
-					cell.is_end[3] = x == 0 or not self.rows[y][x - 1]
-
-	def get_uv(self, cell_x, cell_y, cell_width, face_x, face_y):
-		u = (0.5 + (cell_x + cell_width * face_x / _params.subdivs.x) * _params.cell_size.x) / _params.texture_size.x
-		v = (0.5 + (cell_y + face_y / _params.subdivs.y) * _params.cell_size.y) / _params.texture_size.y
-		return (u, 1 - v)
-	
-	def get_texture_span(self, x, y, is_start_x, is_end_x):
-		width = 1 
-		if _params.double_halves:
-			phase = (x + y + _params.offset) % 2 == 1
-			if (is_start_x and is_end_x) or (is_start_x and phase) or (is_end_x and not phase):
-				width += 1
-				x -= 1 if phase else 0
-
-		x += 1 if _params.offset else 0
-		
-		return x, y, width
-	
-	def apply(self, bm):
-		uv_layer = bm.loops.layers.uv.verify()
-		x_org = random.randrange(0, _params.texture_size.x // _params.cell_size.x, 2) if _params.random else 0
-		y_org = random.randrange(0, _params.texture_size.y // _params.cell_size.y, 2) if _params.random else 0
-		for y in range(self.height):
-			for x in range(self.width):
-				cell = self.rows[y][x]
-				if cell:
-					if _params.rotate:
-						tex_x, tex_y, tex_width = self.get_texture_span(x_org + y, y_org + x, cell.is_end[0], cell.is_end[2])
-					else:
-						tex_x, tex_y, tex_width = self.get_texture_span(x_org + x, y_org + y, cell.is_end[3], cell.is_end[1])
-
-					for face in cell.faces:
-						loop = face.loop
-						fx, fy = (face.y, face.x) if _params.rotate else (face.x, face.y)
-						corners = [(fx, fy), (fx + 1, fy), (fx + 1, fy + 1), (fx, fy + 1)]
-						for i in range(4):
-							loop[uv_layer].uv = self.get_uv(tex_x, tex_y, tex_width, *corners[i])
-							loop = loop.link_loop_prev if _params.rotate else loop.link_loop_next
-		
+		self.firsts = [] # Position of the face's bottom loop, y going upwards.
+		self.xs = []
+		self.ys = []
+
+		if not adjacency.loops[face]:
+			raise RuntimeError('FaceGrid: face not a selected quad')
+
+		first = bottom_loop(adjacency.loops[face])
+
+		neighbours, entries = adjacency.neighbours, adjacency.entries
+
+		# Breadth-first flood fill. Faces are marked in visited when queued, so each is queued once.
+		visited[face] = 1
+		queue = deque([(face, first, 0, 0)])
+		while queue:
+			face, first, x, y = queue.popleft()
+			self.faces.append(face)
+			self.firsts.append(first)
+			self.xs.append(x)
+			self.ys.append(y)
+
+			for i in range(4):
+				link = face * 4 + (first + i) % 4
+				twin_face = neighbours[link]
+				if twin_face >= 0 and not visited[twin_face]:
+					visited[twin_face] = 1
+					queue.append((twin_face, (entries[link] + _twin_adjust_loop[i]) % 4, x + _twin_delta_x[i], y + _twin_delta_y[i]))
+
+		# Make coordinates relative to the bottom left of the grid.
+		min_x, min_y = min(self.xs), min(self.ys)
+		self.xs = [x - min_x for x in self.xs]
+		self.ys = [y - min_y for y in self.ys]
+		self.width, self.height = max(self.xs) + 1, max(self.ys) + 1
+
+		print('FaceGrid: width = %d, height = %d, faces = %d' % (self.width, self.height, len(self.faces)))
+
+class Islands:
+	# Faces of all islands as flat per-face arrays, so each step below is a few array operations in
+	# total, rather than per island; meshes can have thousands of one-face islands.
+	__slots__ = ('count', 'loops', 'islands', 'cell_xs', 'cell_ys', 'face_xs', 'face_ys', 'ends')
+
+	def __init__(self, bm, grids):
+		# Assign the grids' faces to cells.
+		self.count = len(grids)
+		self.loops = [l for grid in grids for face, first in zip(grid.faces, grid.firsts) for l in quad_loops(bm.faces[face].loops, first, _params.rotate)]
+		sizes = [len(grid.faces) for grid in grids]
+		self.islands = np.repeat(np.arange(self.count), sizes)
+		sub_x, sub_y = int(_params.subdivs.x), int(_params.subdivs.y)
+		self.cell_xs, self.face_xs = np.divmod(np.fromiter(chain.from_iterable(grid.xs for grid in grids), np.int32, sum(sizes)), sub_x)
+		self.cell_ys, self.face_ys = np.divmod(np.fromiter(chain.from_iterable(grid.ys for grid in grids), np.int32, sum(sizes)), sub_y)
+
+		# Set cells border states: bit i is set if the cell has no neighbour on side i (CCW from bottom).
+		# Each island's cells get their own block of one flat grid, with a border of empty cells.
+		widths = np.array([(grid.width - 1) // sub_x + 3 for grid in grids])
+		heights = np.array([(grid.height - 1) // sub_y + 3 for grid in grids])
+		blocks = widths * heights
+		strides = widths[self.islands]
+		cells = (np.cumsum(blocks) - blocks)[self.islands] + (self.cell_ys + 1) * strides + self.cell_xs + 1
+		present = np.zeros(int(blocks.sum()), dtype=bool)
+		present[cells] = True
+		missing = ~present
+		self.ends = (missing[cells - strides] | (missing[cells + 1] << 1) | (missing[cells + strides] << 2) | (missing[cells - 1] << 3)).astype(np.uint8)
+
+	def apply(self):
+		# Return the UVs of self.loops, as a float32 array with a row per loop.
+		texture_size, cell_size = _params.texture_size, _params.cell_size
+		rotate, offset, double_halves = _params.rotate, _params.offset, _params.double_halves
+		sub_x, sub_y = int(_params.subdivs.x), int(_params.subdivs.y)
+
+		x_orgs = np.zeros(self.count, dtype=np.int32)
+		y_orgs = np.zeros(self.count, dtype=np.int32)
+		if _params.random:
+			for i in range(self.count):
+				x_orgs[i] = _rng.randrange(0, int(texture_size.x // cell_size.x), 2)
+				y_orgs[i] = _rng.randrange(0, int(texture_size.y // cell_size.y), 2)
+
+		# Get texture span of each face's cell. Rotation swaps the texture axes and which sides start and end a row.
+		along, across = (self.cell_ys, self.cell_xs) if rotate else (self.cell_xs, self.cell_ys)
+		start_bit, end_bit = (1, 4) if rotate else (8, 2)
+		tex_xs = x_orgs[self.islands] + along
+		tex_ys = y_orgs[self.islands] + across
+		tex_widths = np.ones_like(tex_xs)
+		if double_halves:
+			phase = ((tex_xs + tex_ys + offset) & 1).astype(bool)
+			is_start_x, is_end_x = (self.ends & start_bit) != 0, (self.ends & end_bit) != 0
+			double = (is_start_x & is_end_x) | (is_start_x & phase) | (is_end_x & ~phase)
+			tex_widths += double
+			tex_xs -= double & phase
+		tex_xs += 1 if offset else 0
+
+		# Compute all corner UVs at once, one row of four corners per face.
+		face_xs, face_ys = (self.face_ys, self.face_xs) if rotate else (self.face_xs, self.face_ys)
+		u0 = (0.5 + (tex_xs + tex_widths * face_xs / sub_x) * cell_size.x) / texture_size.x
+		u1 = (0.5 + (tex_xs + tex_widths * (face_xs + 1) / sub_x) * cell_size.x) / texture_size.x
+		v0 = 1 - (0.5 + (tex_ys + face_ys / sub_y) * cell_size.y) / texture_size.y
+		v1 = 1 - (0.5 + (tex_ys + (face_ys + 1) / sub_y) * cell_size.y) / texture_size.y
+		return np.stack((u0, v0, u1, v0, u1, v1, u0, v1), axis=1).astype(np.float32).reshape(-1, 2)
+
 def main(context, params):
-	global _params, _islands
+	global _params, _islands, _grids
 	_params = params
-	_islands = []
+	_islands = None
 	me = context.active_object.data
 	bm = bmesh.from_edit_mesh(me)
 
 	if params.coplanar:
 		bpy.ops.mesh.select_similar(type='COPLANAR')
 
-	for face in bm.faces:
-		if face.select:
-			if not find_island(face):
-				_islands.append(Island(face))
-
-	for i in _islands:
-		i.apply(bm)
+	# Snapshot the selection once, after select_similar may have changed it.
+	selected = [f for f in bm.faces if f.select]
+	bm.faces.index_update()
+	bm.faces.ensure_lookup_table()
+
+	# Island layout depends on the selected faces, not on the parameters, so reuse it when the operator
+	# is re-run on an unchanged mesh (e.g. from the redo panel). The key holds each selected face's
+	# vertices in loop order, which covers topology and winding; vertex positions only matter for
+	# each island's first face, whose bottom loop is checked again.
+	bm.verts.index_update()
+	key = (context.active_object.name, len(bm.faces), tuple((f.index, tuple(l.vert.index for l in f.loops)) for f in selected))
+	if not _grids or _grids[0] != key or any(bottom_loop(bm.faces[g.faces[0]].loops) != g.firsts[0] for g in _grids[1]):
+		adjacency = Adjacency(bm, selected)
+		visited = bytearray(len(bm.faces))
+		grids = []
+		for face in selected:
+			if not visited[face.index] and adjacency.loops[face.index]:
+				grids.append(FaceGrid(adjacency, face.index, visited))
+		_grids = (key, grids)
+
+	# Compute all UVs first, then write them to the UV layer in one pass.
+	if _grids[1]:
+		_islands = Islands(bm, _grids[1])
+		uv_layer = bm.loops.layers.uv.verify()
+		for loop, uv in zip(_islands.loops, _islands.apply().tolist()):
+			loop[uv_layer].uv = uv
 
 	bmesh.update_edit_mesh(me)
 
+	# Return the number of selected faces left out, as only quads are laid out.
+	return sum(len(verts) != 4 for face, verts in key[2])
+
 class BrickUvOperator(bpy.types.Operator):
 	bl_idname = "brickuv.operator"
 	bl_label = "Brick UV Operator"
@@ -208,7 +232,9 @@ class BrickUvOperator(bpy.types.Operator):
 
 	def execute(self, context):
 		params = Params(Vector((self.texture_size_u, self.texture_size_v)), Vector((self.cell_size_u, self.cell_size_v)), self.rotate, self.offset, self.double_halves, self.coplanar, self.random, self.subdiv)
-		main(context, params)
+		skipped = main(context, params)
+		if skipped:
+			self.report({'WARNING'}, 'Skipped %d selected non-quad face(s)' % skipped)
 		return {'FINISHED'}
 
 	def invoke(self, context, event):